@@ -1,19 +1,43 @@
 #!/usr/bin/env python
 
 import argparse
+import base64
+import concurrent.futures
+import datetime
+import http.client
+import json
 import logging
+import secrets
+import socket
 import sys
 import os.path
+import threading
 import time
 import yaml
 import subprocess
 
 import code
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # PyYAML built without LibYAML
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    from inotify_simple import INotify, flags
+
+    _REMOVED = flags.DELETE | flags.MOVED_FROM | flags.ONLYDIR
+    _CREATED = flags.CREATE | flags.MOVED_TO | flags.ONLYDIR
+except ImportError:  # not on Linux or inotify_simple not installed
+    INotify = None
+    _REMOVED = _CREATED = 0
+
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s [%(name)s] %(levelname)s: %(message)s"
 )
 _LOGGER = logging.getLogger("rclouned.main")
+_POLLING_LOGGED = False
+_O_BINARY = getattr(os, "O_BINARY", 0)  # no newline translation on Windows
 _CONFIG = {
     "folder": None,
     "remote": None,
@@ -23,6 +47,7 @@ _CONFIG = {
     "dryrun": False,
     "careful": False,
     "exclude": [],
+    "rcd": False,
 }
 
 
@@ -34,148 +59,380 @@ class SyncException(Exception):
     pass
 
 
+def parse_timestamp(ts):
+    # "%Y-%m-%d %H:%M:%S" -> YYYYMMDDhhmmss, ordered like the time it encodes
+    return int(ts[0:4] + ts[5:7] + ts[8:10] + ts[11:13] + ts[14:16] + ts[17:19])
+
+
+def local_timestamp(epoch):
+    # same local-time encoding as parse_timestamp applied to rclone lsf output
+    return int(time.strftime("%Y%m%d%H%M%S", time.localtime(epoch)))
+
+
+def parse_rfc3339(ts):
+    # rclone rc modtimes are RFC 3339 with up to nanoseconds, lsf prints local time.
+    # Python < 3.11 fromisoformat takes neither "Z" nor 9 fraction digits.
+    offset = ts[19:].lstrip(".0123456789")
+    if offset in ("Z", "z"):
+        offset = "+00:00"
+    dt = datetime.datetime.fromisoformat(ts[:19] + offset).astimezone()
+    return int(dt.strftime("%Y%m%d%H%M%S"))
+
+
+def dump_list(path, items):
+    with open(path, "wb") as file:
+        file.writelines(item.encode() + b"\n" for item in items)
+
+
+def _log_polling_fallback():
+    global _POLLING_LOGGED
+    if not _POLLING_LOGGED:
+        _POLLING_LOGGED = True
+        _LOGGER.debug("inotify_simple is not available, polling once per second.")
+
+
+def wait_until(predicate, directory, mask, timeout=30000):
+    """Block until predicate() is true, rechecking on inotify events in directory.
+
+    Without inotify, or while directory does not exist, recheck every second.
+    """
+    watch = None
+    try:
+        while not predicate():
+            if watch is not None:
+                events = watch.read(timeout=timeout)
+                if any(event.mask & flags.IGNORED for event in events):
+                    # directory is gone, re-arm once it is back
+                    watch.close()
+                    watch = None
+                continue
+            if INotify is None:
+                _log_polling_fallback()
+            else:
+                # arm the watch before rechecking so nothing in between is missed
+                watch = INotify()
+                try:
+                    watch.add_watch(directory, mask)
+                    continue
+                except OSError:
+                    watch.close()
+                    watch = None
+            time.sleep(1)
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+class RcloneDaemon:
+    """A long-running `rclone rcd` shared by all syncs of this process.
+
+    Saves the rclone start-up and remote (re)connection on every command.
+    """
+
+    def __init__(self, options):
+        self.logger = logging.getLogger("rclouned.rcd")
+        self._options = options
+        self._local = threading.local()
+        self._restart = threading.Lock()
+        self._proc = None
+
+    def start(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        # the rc API can run any rclone operation, keep other local users out
+        password = secrets.token_urlsafe(24)
+        auth = "Basic " + base64.b64encode(("rclouned:" + password).encode()).decode(
+            "ascii"
+        )
+        # one tuple, so transfer threads never see a port without its password
+        self._endpoint = (port, auth)
+        cmd = ["rclone", "rcd", f"--rc-addr=127.0.0.1:{port}"] + self._options
+        self.logger.debug("Starting rclone daemon: " + str(cmd))
+        self._proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            env=dict(os.environ, RCLONE_RC_USER="rclouned", RCLONE_RC_PASS=password),
+        )
+        for _ in range(100):
+            if self._proc.poll() is not None:
+                raise SyncException(
+                    "rclone rcd exited with exit code " + str(self._proc.returncode)
+                )
+            try:
+                self._request("rc/noop", {})
+                return
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.1)
+        raise SyncException("rclone rcd did not come up.")
+
+    def stop(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+
+    def call(self, endpoint, params):
+        with self._restart:
+            if self._proc.poll() is not None:
+                self.logger.warning(
+                    "rclone rcd exited with exit code "
+                    + str(self._proc.returncode)
+                    + ", restarting it."
+                )
+                self.start()
+        self.logger.debug("Calling rclone rc " + endpoint + ": " + str(params))
+        try:
+            response, result = self._request(endpoint, params)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise SyncException("rclone rc " + endpoint + " failed: " + str(e))
+        if response.status != 200:
+            raise SyncException(
+                "rclone rc " + endpoint + " failed: " + str(result.get("error"))
+            )
+        return result
+
+    def run_job(self, endpoint, params):
+        # a blocking call would lose its response to rcd's HTTP write timeout
+        # (1h by default) on long transfers, so run it as a job and poll that
+        jobid = self.call(endpoint, dict(params, _async=True))["jobid"]
+        delay = 0.1
+        while True:
+            status = self.call("job/status", {"jobid": jobid})
+            if status["finished"]:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+        if not status["success"]:
+            raise SyncException(
+                "rclone rc " + endpoint + " failed: " + str(status.get("error"))
+            )
+        return status.get("output") or {}
+
+    def _request(self, endpoint, params):
+        port, auth = self._endpoint
+        # keep-alive connections are not thread safe, transfers run in threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.port != port:
+            conn = self._local.conn = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            conn.request(
+                "POST",
+                "/" + endpoint,
+                json.dumps(params),
+                {"Content-Type": "application/json", "Authorization": auth},
+            )
+            response = conn.getresponse()
+            result = json.load(response)
+        except (OSError, http.client.HTTPException, ValueError):
+            conn.close()
+            self._local.conn = None
+            raise
+        return response, result
+
+
 class Sync:
-    def __init__(self, configuration):
+    def __init__(self, configuration, daemon=None):
         self.configuration = configuration
+        self._daemon = daemon
         self.logger = logging.getLogger("rclouned.syncer")
-
-    def config(self, key):
-        if key in self.configuration:
-            return self.configuration[key]
-        else:
-            return None
+        self._folder = configuration["folder"].rstrip("/") + "/"
+        self._tmp = f"{self._folder}.rclouned/sync.tmp/"
+        self._lock = f"{self._tmp}.lock"
+        self._lastsync_file = f"{self._folder}.rclouned/lastsync.txt"
+        self._remote_spec = (
+            f'{configuration["remote"]}:{configuration.get("subdir") or ""}'
+        )
+        self._opts = [o for o in (configuration.get("options") or "").split() if o]
+        self._exclude = configuration.get("exclude") or []
+        self._dryrun = bool(configuration.get("dryrun"))
+        self._careful = bool(configuration.get("careful"))
 
     def acquire_lock(self):
-        i = 0
-        while os.path.exists(self.config("folder") + ".rclouned/sync.tmp/"):
-            i += 1
+        # sync.tmp stays around between syncs, only the lock file comes and goes
+        os.makedirs(self._tmp, exist_ok=True)
+
+        def try_lock():
+            # O_EXCL creation is atomic, so whoever creates the file holds the lock
+            while True:
+                try:
+                    os.close(os.open(self._lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                    return True
+                except FileExistsError:
+                    return False
+                except FileNotFoundError:
+                    # sync.tmp was removed by hand or by an older rclouned
+                    os.makedirs(self._tmp, exist_ok=True)
+
+        if not try_lock():
             self.logger.info(
-                "Sync Lock exists. Check whether this is desired and otherwise remove the .rclouned/sync.tmp/ folder. Waiting."
+                "Sync Lock exists. Check whether this is desired and otherwise remove the .rclouned/sync.tmp/.lock file. Waiting."
             )
-            time.sleep(10 + i ** 2)
-        os.mkdir(self.config("folder") + ".rclouned/sync.tmp/")
+            wait_until(try_lock, self._tmp, _REMOVED)
 
     def release_lock(self):
         try:
-            os.rmdir(self.config("folder") + ".rclouned/sync.tmp/")
+            os.remove(self._lock)
         except OSError as e:
             self.logger.warning("Failed to remove Sync Lock.")
             self.logger.exception(e)
 
     def exec_cmd(self, cmd, check_ec=True):
         self.logger.debug("Running an external command: " + str(cmd))
-        exe = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            check=check_ec,
-        )
+        # output is not used, errors still reach our stderr
+        exe = subprocess.run(cmd, stdout=subprocess.DEVNULL, check=check_ec)
         self.logger.debug(
-            "External command returned with exit code "
-            + str(exe.returncode)
-            + ", output:"
+            "External command returned with exit code " + str(exe.returncode)
         )
-        self.logger.debug(exe.stdout)
-        return exe.stdout
 
     def exec_rclone(self, cmd, check_ec=True):
-        opts = list(filter(lambda x: len(x) > 0, self.config("options").split(" ")))
-        if self.config("dryrun") and cmd[0] != "check":
+        opts = list(self._opts)
+        if self._dryrun and cmd[0] != "check":
             opts.append("--dry-run")
-        return self.exec_cmd(["rclone"] + opts + cmd, check_ec=check_ec)
+        self.exec_cmd(["rclone"] + opts + cmd, check_ec=check_ec)
+
+    def exec_rclone_stream(self, cmd, check_ec=True, returncode=None):
+        # returncode: optional list that receives the exit code once streamed
+        cmd = ["rclone"] + self._opts + cmd
+        self.logger.debug("Running an external command: " + str(cmd))
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, encoding="utf-8", bufsize=1 << 17
+        ) as proc:
+            yield from proc.stdout
+        self.logger.debug(
+            "External command returned with exit code " + str(proc.returncode)
+        )
+        if check_ec and proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        if returncode is not None:
+            returncode.append(proc.returncode)
+
+    def read_modtimes(self, files_from, fs, modtimes):
+        if self._daemon is not None:
+            result = self._daemon.run_job(
+                "operations/list",
+                {
+                    "fs": fs,
+                    "remote": "",
+                    "opt": {"recurse": True, "filesOnly": True, "noMimeType": True},
+                    "_filter": {"FilesFrom": [files_from]},
+                },
+            )
+            for item in result["list"]:
+                modtimes[item["Path"]] = parse_rfc3339(item["ModTime"])
+            return
+
+        cmd = ["lsf", "--format", "pt", "-R", "--files-from", files_from, fs]
+        for line in self.exec_rclone_stream(cmd):
+            line = line.rstrip()
+            if not line:
+                continue
+            key, _, modtime = line.rpartition(";")
+            modtimes[key] = parse_timestamp(modtime)
 
     def load_last_sync(self):
+        # a single short line, skip the buffered file object
         try:
-            with open(self.config("folder") + ".rclouned/lastsync.txt", "r") as file:
-                self.lastsync = time.strptime(
-                    file.read().splitlines()[0].strip(), "%Y-%m-%d %H:%M:%S"
-                )
+            fd = os.open(self._lastsync_file, os.O_RDONLY | _O_BINARY)
         except FileNotFoundError:
-            self.lastsync = time.localtime(0)
+            self.lastsync = 0
+            return
+        try:
+            data = os.read(fd, 64)
+        finally:
+            os.close(fd)
+        self.lastsync = parse_timestamp(data.split(b"\n", 1)[0].strip().decode())
 
     def run_check(self):
         self.syncstart = time.strftime("%Y-%m-%d %H:%M:%S")
-        cmd = [
-            "check",
-            "--differ",
-            self.config("folder") + ".rclouned/sync.tmp/diff.txt",
-            "--missing-on-dst",
-            self.config("folder") + ".rclouned/sync.tmp/dst.txt",
-            "--missing-on-src",
-            self.config("folder") + ".rclouned/sync.tmp/src.txt",
-            "--exclude",
-            ".rclouned/**",
-        ] + [
-            x for y in self.config("exclude") for x in ["--exclude", y]
-        ] + [
-            self.config("remote") + ":" + self.config("subdir"),
-            self.config("folder"),
-        ]
-        self.exec_rclone(cmd, check_ec=False)
-
-        with open(self.config("folder") + ".rclouned/sync.tmp/diff.txt", "r") as file:
-            self.diff = [str.strip() for str in file.read().splitlines()]
-        with open(self.config("folder") + ".rclouned/sync.tmp/dst.txt", "r") as file:
-            self.dst = [str.strip() for str in file.read().splitlines()]
-        with open(self.config("folder") + ".rclouned/sync.tmp/src.txt", "r") as file:
-            self.src = [str.strip() for str in file.read().splitlines()]
-
-        os.remove(self.config("folder") + ".rclouned/sync.tmp/diff.txt")
-        os.remove(self.config("folder") + ".rclouned/sync.tmp/dst.txt")
-        os.remove(self.config("folder") + ".rclouned/sync.tmp/src.txt")
+        self.diff = []
+        self.dst = []
+        self.src = []
+        # source is the remote, destination the local folder:
+        # "*" differs, "+" missing on dst (local), "-" missing on src (remote)
+        buckets = {"*": self.diff, "+": self.dst, "-": self.src}
+
+        if self._daemon is not None:
+            result = self._daemon.run_job(
+                "operations/check",
+                {
+                    "srcFs": self._remote_spec,
+                    "dstFs": self._folder,
+                    "combined": True,
+                    "_filter": {"ExcludeRule": [".rclouned/**"] + self._exclude},
+                },
+            )
+            lines = result.get("combined") or []
+            returncode = [0 if result.get("success") else 1]
+        else:
+            cmd = (
+                [
+                    "check",
+                    "--combined",
+                    "-",
+                    "--exclude",
+                    ".rclouned/**",
+                ]
+                + [x for y in self._exclude for x in ["--exclude", y]]
+                + [
+                    self._remote_spec,
+                    self._folder,
+                ]
+            )
+            returncode = []
+            lines = self.exec_rclone_stream(cmd, check_ec=False, returncode=returncode)
+
+        errors = []
+        for line in lines:
+            tag, _, path = line.rstrip("\n").partition(" ")
+            bucket = buckets.get(tag)
+            if bucket is not None:
+                bucket.append(path)
+            elif tag == "!":
+                errors.append(path)
+
+        failed = returncode[0] != 0
+        if errors:
+            raise SyncException("rclone check failed for: " + str(errors))
+        # check also exits non-zero when it finds differences, but a failure
+        # without any reported difference must not pass for "nothing changed"
+        if failed and not (self.diff or self.dst or self.src):
+            raise SyncException("rclone check failed without reporting anything.")
 
     def get_modtimes(self):
         self.local_check = {}
         self.remote_check = {}
 
-        for file in self.diff:
-            self.local_check[file] = None
-            self.remote_check[file] = None
-        for file in self.dst:
-            self.remote_check[file] = None
-        for file in self.src:
-            self.local_check[file] = None
-
-        with open(
-            self.config("folder") + ".rclouned/sync.tmp/local_check.txt", "w"
-        ) as file:
-            file.write("\n".join(self.local_check.keys()))
-
-        cmd = [
-            "lsf",
-            "--format",
-            "pt",
-            "-R",
-            "--files-from",
-            self.config("folder") + ".rclouned/sync.tmp/local_check.txt",
-            self.config("folder"),
-        ]
-        local_modtimes = self.exec_rclone(cmd)
-        for line in [str.strip() for str in local_modtimes.splitlines()]:
-            key, modtime = line.split(";")
-            self.local_check[key] = time.strptime(modtime, "%Y-%m-%d %H:%M:%S")
-        os.remove(self.config("folder") + ".rclouned/sync.tmp/local_check.txt")
-
-        with open(
-            self.config("folder") + ".rclouned/sync.tmp/remote_check.txt", "w"
-        ) as file:
-            file.write("\n".join(self.remote_check.keys()))
+        local_keys = set(self.diff)
+        local_keys.update(self.src)
+        remote_keys = set(self.diff)
+        remote_keys.update(self.dst)
 
-        cmd = [
-            "lsf",
-            "--format",
-            "pt",
-            "-R",
-            "--files-from",
-            self.config("folder") + ".rclouned/sync.tmp/remote_check.txt",
-            self.config("remote") + ":" + self.config("subdir"),
-        ]
-        remote_modtimes = self.exec_rclone(cmd)
-        for line in [str.strip() for str in remote_modtimes.splitlines()]:
-            key, modtime = line.split(";")
-            self.remote_check[key] = time.strptime(modtime, "%Y-%m-%d %H:%M:%S")
-        os.remove(self.config("folder") + ".rclouned/sync.tmp/remote_check.txt")
+        # stat the few local files directly, rclone is only needed for names it
+        # stores encoded on disk (e.g. fullwidth ":" on Windows)
+        unresolved = []
+        for key in local_keys:
+            try:
+                mtime = os.stat(self._folder + key).st_mtime
+            except OSError:
+                unresolved.append(key)
+                continue
+            self.local_check[key] = local_timestamp(mtime)
+
+        if unresolved:
+            local_files_from = f"{self._tmp}local_check.txt"
+            dump_list(local_files_from, unresolved)
+            self.read_modtimes(local_files_from, self._folder, self.local_check)
+            missing = [key for key in unresolved if key not in self.local_check]
+            if missing:
+                # changed since rclone check, the next sync will pick it up
+                raise SyncException("Local files vanished during sync: " + str(missing))
+
+        # nothing changed is the common case, don't start rclone for nothing
+        if remote_keys:
+            remote_files_from = f"{self._tmp}remote_check.txt"
+            dump_list(remote_files_from, remote_keys)
+            self.read_modtimes(remote_files_from, self._remote_spec, self.remote_check)
 
     def sort(self):
         conflict_suffix = "_conflict-" + time.strftime("%Y%m%d-%H%M%S")
@@ -185,37 +442,44 @@ class Sync:
         self.local_backup = []
         self.remote_backup = []
 
+        # the loops run once per changed file, keep their lookups local
+        upload = self.upload.append
+        download = self.download.append
+        local_move = self.local_move.append
+        local_backup = self.local_backup.append
+        remote_backup = self.remote_backup.append
+        local_check = self.local_check
+        remote_check = self.remote_check
+        lastsync = self.lastsync
+        careful = self._careful
+
         for file in self.diff:
-            if (
-                self.local_check[file] >= self.lastsync
-                and self.remote_check[file] < self.lastsync
-            ):
-                self.upload.append(file)
-                if self.config("careful"):
-                    self.remote_backup.append(file)
-            elif (
-                self.local_check[file] < self.lastsync
-                and self.remote_check[file] >= self.lastsync
-            ):
-                self.download.append(file)
-                if self.config("careful"):
-                    self.local_backup.append(file)
+            local_new = local_check[file] >= lastsync
+            remote_new = remote_check[file] >= lastsync
+            if local_new and not remote_new:
+                upload(file)
+                if careful:
+                    remote_backup(file)
+            elif remote_new and not local_new:
+                download(file)
+                if careful:
+                    local_backup(file)
             else:
-                self.local_move.append([file, file + conflict_suffix])
-                self.download.append(file)
-                self.upload.append(file + conflict_suffix)
+                local_move([file, file + conflict_suffix])
+                download(file)
+                upload(file + conflict_suffix)
 
         for file in self.src:  # missing on remote
-            if self.local_check[file] >= self.lastsync:
-                self.upload.append(file)
+            if local_check[file] >= lastsync:
+                upload(file)
             else:
-                self.local_backup.append(file)
+                local_backup(file)
 
         for file in self.dst:  # missing on local
-            if self.remote_check[file] >= self.lastsync:
-                self.download.append(file)
+            if remote_check[file] >= lastsync:
+                download(file)
             else:
-                self.remote_backup.append(file)
+                remote_backup(file)
 
     def log_summary(self):
         self.logger.info("SYNC PLAN:")
@@ -226,97 +490,91 @@ class Sync:
         self.logger.info("Files to download: " + str(self.download))
 
     def action(self):
-        backup_prefix = ".rclouned/backups/" + time.strftime("%Y%m%d-%H%M%S") + "/"
+        backup_prefix = f".rclouned/backups/{time.strftime('%Y%m%d-%H%M%S')}/"
 
-        if not self.config("dryrun"):
+        if not self._dryrun:
             for file in self.local_move:
-                self.exec_cmd(
-                    [
-                        "mv",
-                        self.config("folder") + file[0],
-                        self.config("folder") + file[1],
-                    ]
+                try:
+                    os.replace(self._folder + file[0], self._folder + file[1])
+                except OSError as e:
+                    self.logger.warning("Failed to move " + file[0] + ".")
+                    # the download would overwrite the unmoved local changes
+                    raise SyncException(e)
+
+        # backups delete the files they save, let them finish before transferring
+        stages = [
+            [
+                (
+                    "local_backup",
+                    self.local_backup,
+                    self._folder,
+                    f"{self._folder}{backup_prefix}",
+                    True,
+                ),
+                (
+                    "remote_backup",
+                    self.remote_backup,
+                    self._remote_spec,
+                    f"{self._remote_spec}{backup_prefix}",
+                    True,
+                ),
+            ],
+            [
+                ("upload", self.upload, self._folder, self._remote_spec, False),
+                ("download", self.download, self._remote_spec, self._folder, False),
+            ],
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for stage in stages:
+                futures = [
+                    executor.submit(self.transfer, *job) for job in stage if len(job[1])
+                ]
+                for future in futures:
+                    future.result()
+
+    def transfer(self, name, files, src, dst, delete):
+        files_from = f"{self._tmp}{name}.txt"
+        dump_list(files_from, files)
+        if self._daemon is not None:
+            params = {"_filter": {"FilesFrom": [files_from]}}
+            if self._dryrun:
+                params["_config"] = {"DryRun": True}
+            self._daemon.run_job("sync/copy", dict(params, srcFs=src, dstFs=dst))
+            if delete:
+                # what `rclone delete --rmdirs` does
+                self._daemon.run_job("operations/delete", dict(params, fs=src))
+                self._daemon.run_job(
+                    "operations/rmdirs",
+                    dict(params, fs=src, remote="", leaveRoot=True),
                 )
+            return
 
-        if len(self.local_backup):
-            with open(
-                self.config("folder") + ".rclouned/sync.tmp/local_backup.txt", "w"
-            ) as file:
-                file.write("\n".join(self.local_backup))
-            cmd = [
-                "copy",
-                "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/local_backup.txt",
-                self.config("folder"),
-                self.config("folder") + backup_prefix,
-            ]
-            self.exec_rclone(cmd)
-            cmd = [
-                "delete",
-                "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/local_backup.txt",
-                self.config("folder"),
-                "--rmdirs",
-            ]
-            self.exec_rclone(cmd)
-            os.remove(self.config("folder") + ".rclouned/sync.tmp/local_backup.txt")
-
-        if len(self.remote_backup):
-            with open(
-                self.config("folder") + ".rclouned/sync.tmp/remote_backup.txt", "w"
-            ) as file:
-                file.write("\n".join(self.remote_backup))
-            cmd = [
-                "copy",
-                "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/remote_backup.txt",
-                self.config("remote") + ":" + self.config("subdir"),
-                self.config("remote") + ":" + self.config("subdir") + backup_prefix,
-            ]
-            self.exec_rclone(cmd)
+        cmd = [
+            "copy",
+            "--files-from",
+            files_from,
+            src,
+            dst,
+        ]
+        self.exec_rclone(cmd)
+        if delete:
             cmd = [
                 "delete",
                 "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/remote_backup.txt",
-                self.config("remote") + ":" + self.config("subdir"),
+                files_from,
+                src,
                 "--rmdirs",
             ]
             self.exec_rclone(cmd)
-            os.remove(self.config("folder") + ".rclouned/sync.tmp/remote_backup.txt")
-
-        if len(self.upload):
-            with open(
-                self.config("folder") + ".rclouned/sync.tmp/upload.txt", "w"
-            ) as file:
-                file.write("\n".join(self.upload))
-            cmd = [
-                "copy",
-                "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/upload.txt",
-                self.config("folder"),
-                self.config("remote") + ":" + self.config("subdir"),
-            ]
-            self.exec_rclone(cmd)
-            os.remove(self.config("folder") + ".rclouned/sync.tmp/upload.txt")
-
-        if len(self.download):
-            with open(
-                self.config("folder") + ".rclouned/sync.tmp/download.txt", "w"
-            ) as file:
-                file.write("\n".join(self.download))
-            cmd = [
-                "copy",
-                "--files-from",
-                self.config("folder") + ".rclouned/sync.tmp/download.txt",
-                self.config("remote") + ":" + self.config("subdir"),
-                self.config("folder"),
-            ]
-            self.exec_rclone(cmd)
-            os.remove(self.config("folder") + ".rclouned/sync.tmp/download.txt")
 
     def set_last_sync(self):
-        with open(self.config("folder") + ".rclouned/lastsync.txt", "w") as file:
-            file.write(self.syncstart + "\n")
+        fd = os.open(
+            self._lastsync_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY
+        )
+        try:
+            os.write(fd, self.syncstart.encode() + b"\n")
+        finally:
+            os.close(fd)
 
     def run(self):
         self.load_last_sync()
@@ -325,17 +583,18 @@ class Sync:
         self.sort()
         self.log_summary()
         self.action()
-        if not self.config("dryrun"):
+        if not self._dryrun:
             self.set_last_sync()
         # code.interact(local=dict(globals(), **locals()))
 
 
 def wait_for_folder():
-    i = 0
-    while not os.path.exists(_CONFIG["folder"]):
-        i += 1
+    folder = os.path.abspath(_CONFIG["folder"].rstrip("/"))
+    if not os.path.exists(folder):
         _LOGGER.info("Folder does not exist. Waiting.")
-        time.sleep(10 + i ** 2)
+        wait_until(
+            lambda: os.path.exists(folder), os.path.dirname(folder), _CREATED, 60000
+        )
 
 
 def parse_config():
@@ -348,7 +607,7 @@ def parse_config():
         raise ConfigException("Configuration file not found.")
 
     with open(_CONFIG["folder"] + ".rclouned/config.yaml", "r") as file:
-        config = yaml.load(file, Loader=yaml.SafeLoader)
+        config = yaml.load(file.read(), Loader=_YamlLoader)
         _CONFIG |= config
 
     if not _CONFIG["remote"]:
@@ -357,26 +616,31 @@ def parse_config():
 
 def sync_loop():
     # code.interact(local=dict(globals(), **locals()))
-    while True:
-        start = time.time()
-        _LOGGER.info("Starting a new sync.")
-        syncer = Sync(_CONFIG)
-        syncer.acquire_lock()
-        try:
-            syncer.run()
-        except SyncException as e:
-            _LOGGER.warning("Error during sync!")
-            _LOGGER.exception(e)
-        finally:
-            syncer.release_lock()
-        runtime = time.time() - start
-        _LOGGER.info("Sync ended. Runtime " + str(runtime) + "s.")
-        if not (_CONFIG["interval"] - runtime) < 0:
+    daemon = None
+    if _CONFIG["rcd"]:
+        daemon = RcloneDaemon([o for o in (_CONFIG.get("options") or "").split() if o])
+        daemon.start()
+    try:
+        while True:
+            start = time.monotonic()
+            _LOGGER.info("Starting a new sync.")
+            syncer = Sync(_CONFIG, daemon)
+            syncer.acquire_lock()
             try:
-                time.sleep(int(_CONFIG["interval"] - runtime))
-            except KeyboardInterrupt:
-                _LOGGER.info("KeyboardInterrupt detected. Quitting.")
-                sys.exit(0)
+                syncer.run()
+            except SyncException as e:
+                _LOGGER.warning("Error during sync!")
+                _LOGGER.exception(e)
+            finally:
+                syncer.release_lock()
+            runtime = time.monotonic() - start
+            _LOGGER.info("Sync ended. Runtime " + str(runtime) + "s.")
+            sleep_for = _CONFIG["interval"] - runtime
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+    finally:
+        if daemon is not None:
+            daemon.stop()
 
 
 def main():
@@ -399,6 +663,9 @@ def main():
         parse_config()
 
         sync_loop()
+    except KeyboardInterrupt:
+        _LOGGER.info("KeyboardInterrupt detected. Quitting.")
+        sys.exit(0)
     except Exception as e:
         _LOGGER.critical("rclouned encountered a critical error and cannot continue.")
         _LOGGER.exception(e)